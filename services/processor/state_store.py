@@ -1,10 +1,15 @@
 import os
-import json
 import tempfile
 import fcntl
-from typing import Dict, Any, Callable
+from datetime import datetime
+from contextlib import contextmanager
+from typing import Dict, Any, Callable, Iterator, List
+
+import orjson
+
 
 # Helper to write JSON atomically to a file.
+# orjson output is compact (no indentation): the file is machine-read only.
 
 
 def _atomic_write_json(path: str, data: Dict[str, Any]) -> None:
@@ -14,8 +19,8 @@ def _atomic_write_json(path: str, data: Dict[str, Any]) -> None:
     fd, tmp_path = tempfile.mkstemp(
         prefix="state_", suffix=".json", dir=directory)
     try:
-        with os.fdopen(fd, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2)
+        with os.fdopen(fd, "wb") as f:
+            f.write(orjson.dumps(data))
             f.flush()
             os.fsync(f.fileno())
 
@@ -30,38 +35,114 @@ def _atomic_write_json(path: str, data: Dict[str, Any]) -> None:
             pass
 
 
+def _ensure_shape(state: Dict[str, Any]) -> None:
+    # Ensure expected shape (backward compatible if schema evolves).
+    state.setdefault("processed_keys", {})
+    if isinstance(state["processed_keys"], list):
+        # Older files stored a plain list; its keys start their TTL now.
+        now = datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
+        state["processed_keys"] = dict.fromkeys(state["processed_keys"], now)
+    state.setdefault("ingest_results", {})
+    state.setdefault("pending_ingests", {})
+    state.setdefault("webhook_events", {})
+
+
+# Lock-free read for advisory checks: writers replace the file atomically, so a
+# plain read sees a complete snapshot. A failed parse is retried once.
+def read_state_snapshot(path: str, init_state: Dict[str, Any]) -> Dict[str, Any]:
+    for attempt in range(2):
+        try:
+            with open(path, "rb") as f:
+                state = orjson.loads(f.read())
+            break
+        except FileNotFoundError:
+            state = dict(init_state)
+            break
+        except ValueError:
+            if attempt:
+                raise
+
+    _ensure_shape(state)
+    return state
+
+
 # Main function to manage state with locking.
 def with_locked_state(
     path: str,
     init_state: Dict[str, Any],
     fn: Callable[[Dict[str, Any]], None],
+    readonly: bool = False,
 ) -> Dict[str, Any]:
     lock_path = path + ".lock"
     os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
 
     # Lock file handle must remain open while holding the lock.
     with open(lock_path, "w") as lockf:
-        fcntl.flock(lockf, fcntl.LOCK_EX)
+        # Read-only callers share the lock and skip the rewrite.
+        fcntl.flock(lockf, fcntl.LOCK_SH if readonly else fcntl.LOCK_EX)
 
         if os.path.exists(path):
-            with open(path, "r", encoding="utf-8") as f:
-                state = json.load(f)
+            with open(path, "rb") as f:
+                state = orjson.loads(f.read())
         else:
             state = dict(init_state)
 
-        # Ensure expected shape (backward compatible if schema evolves).
-        state.setdefault("processed_keys", [])
-        state.setdefault("ingest_results", {})
-        state.setdefault("pending_ingests", {})
-        state.setdefault("webhook_events", {})
+        _ensure_shape(state)
 
         # Apply the caller's mutation under the lock.
         fn(state)
 
         # Persist atomically before releasing the lock.
-        _atomic_write_json(path, state)
+        if not readonly:
+            _atomic_write_json(path, state)
 
         # Explicit unlock (optional; context exit would close the file anyway).
         fcntl.flock(lockf, fcntl.LOCK_UN)
 
     return state
+
+
+# Append-only JSONL sidecar for high-rate producers (webhook callbacks): one
+# O_APPEND write per record instead of a locked read/rewrite of the state file.
+# Appenders share the log lock; drain_event_log takes it exclusively.
+def append_event_line(path: str, record: Dict[str, Any]) -> None:
+    line = orjson.dumps(record) + b"\n"
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    with open(path + ".lock", "w") as lockf:
+        fcntl.flock(lockf, fcntl.LOCK_SH)
+
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+# Yields all records appended so far while blocking new appends. The log is
+# truncated only if the caller's block completes, i.e. after it has persisted
+# the records; a crash before that replays them on the next drain.
+@contextmanager
+def drain_event_log(path: str) -> Iterator[List[Dict[str, Any]]]:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    with open(path + ".lock", "w") as lockf:
+        fcntl.flock(lockf, fcntl.LOCK_EX)
+
+        records: List[Dict[str, Any]] = []
+        try:
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        records.append(orjson.loads(line))
+                    except ValueError:
+                        # Torn line from a crash mid-append.
+                        continue
+        except FileNotFoundError:
+            pass
+
+        yield records
+
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            os.truncate(path, 0)
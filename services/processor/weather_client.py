@@ -1,7 +1,10 @@
 import os
+import threading
 import time
+from functools import lru_cache
 import requests
-from typing import Optional, Dict, Any, Tuple
+from requests.adapters import HTTPAdapter
+from typing import Optional, Any, Tuple
 
 WEATHER_ENABLED = os.getenv("WEATHER_ENABLED", "0") == "1"
 BASE_URL = os.getenv("WEATHER_API_BASE_URL",
@@ -17,53 +20,102 @@ ROUND_DECIMALS = int(os.getenv("WEATHER_ROUND_DECIMALS", "1"))
 WEATHER_RPS = float(os.getenv("WEATHER_RPS", "5"))
 _MIN_INTERVAL = (1.0 / WEATHER_RPS) if WEATHER_RPS > 0 else 0.0
 _last_request_ts = 0.0
+_rate_lock = threading.Lock()
 
 # Failure protection: after N consecutive failures, stop calling the API for a cooldown period.
 FAIL_STREAK_MAX = int(os.getenv("WEATHER_FAIL_STREAK_MAX", "5"))
 FAIL_COOLDOWN_SECONDS = int(os.getenv("WEATHER_FAIL_COOLDOWN_SECONDS", "60"))
 
-# In-memory TTL cache: key -> (expires_at, data)
-_cache: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+# In-memory cache of successful lookups, keyed by rounded (lat, lon).
+CACHE_SIZE = int(os.getenv("WEATHER_CACHE_SIZE", "4096"))
 _fail_streak = 0
 _cooldown_until = 0.0
 
 # Reuse HTTP connections to reduce latency and overhead.
+# Pool sized for concurrently mapped files. Retries are done by
+# _fetch_weather_cached (not the adapter) so every attempt goes through the
+# rate limiter; 429 is not retried and is left to the failure cooldown below.
+WEATHER_RETRIES = int(os.getenv("WEATHER_RETRIES", "2"))
+_RETRY_STATUSES = (500, 502, 503, 504)
 _session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=0)
+_session.mount("http://", _adapter)
+_session.mount("https://", _adapter)
 
 
-def _cache_get(key: str) -> Optional[Dict[str, Any]]:
-    item = _cache.get(key)
-    if not item:
-        return None
+def _rate_limit_sleep() -> None:
+    global _last_request_ts
 
-    expires_at, data = item
-    if time.time() > expires_at:
-        _cache.pop(key, None)
-        return None
+    if _MIN_INTERVAL <= 0:
+        return
 
-    return data
+    # Files may be mapped concurrently; keep the global RPS budget shared.
+    with _rate_lock:
+        now = time.time()
+        wait = (_last_request_ts + _MIN_INTERVAL) - now
+        if wait > 0:
+            time.sleep(wait)
 
+        _last_request_ts = time.time()
 
-def _cache_set(key: str, data: Dict[str, Any]) -> None:
-    _cache[key] = (time.time() + CACHE_TTL, data)
 
+# One API call per rounded coordinate and TTL period. The period index is part
+# of the key, so entries expire together every CACHE_TTL seconds; failures
+# raise and are therefore never cached.
+@lru_cache(maxsize=CACHE_SIZE)
+def _fetch_weather_cached(lat_n: float, lon_n: float, ttl_period: int) -> Tuple[Any, ...]:
+    global _fail_streak
 
-def _rate_limit_sleep() -> None:
-    global _last_request_ts
+    params = {
+        "latitude": lat_n,
+        "longitude": lon_n,
+        "current": "temperature_2m,wind_speed_10m,precipitation,weather_code",
+        "timezone": "UTC",
+    }
 
-    if _MIN_INTERVAL <= 0:
-        return
+    for attempt in range(WEATHER_RETRIES + 1):
+        last = attempt == WEATHER_RETRIES
+        _rate_limit_sleep()
 
-    now = time.time()
-    wait = (_last_request_ts + _MIN_INTERVAL) - now
-    if wait > 0:
-        time.sleep(wait)
+        try:
+            r = _session.get(BASE_URL, params=params, timeout=TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout):
+            if last:
+                raise
+            continue
+
+        if r.status_code in _RETRY_STATUSES and not last:
+            r.close()
+            continue
+
+        r.raise_for_status()
+        break
+
+    j = r.json()
+
+    # Same order as the Processor's meteo_* columns (source, temperature_c,
+    # wind_kmh, precip_mm, code, time_utc), so rows can use it as-is.
+    cur = (j.get("current") or {})
+    data = (
+        "open-meteo",
+        cur.get("temperature_2m"),
+        cur.get("wind_speed_10m"),
+        cur.get("precipitation"),
+        cur.get("weather_code"),
+        cur.get("time"),
+    )
+
+    _fail_streak = 0
+    return data
 
-    _last_request_ts = time.time()
+
+# TTL period for `now`; the Processor keys its own cache on the same period.
+def ttl_period(now: float) -> int:
+    return int(now // max(1, CACHE_TTL))
 
 
 # Main function to fetch weather data.
-def fetch_weather(lat: float, lon: float) -> Optional[Dict[str, Any]]:
+def fetch_weather(lat: float, lon: float) -> Optional[Tuple[Any, ...]]:
     global _fail_streak, _cooldown_until
 
     if not WEATHER_ENABLED:
@@ -76,42 +128,12 @@ def fetch_weather(lat: float, lon: float) -> Optional[Dict[str, Any]]:
     # Normalize coordinates to reduce cache cardinality and external API calls.
     lat_n = round(float(lat), ROUND_DECIMALS)
     lon_n = round(float(lon), ROUND_DECIMALS)
-    key = f"{lat_n:.{ROUND_DECIMALS}f}:{lon_n:.{ROUND_DECIMALS}f}"
-
-    cached = _cache_get(key)
-    if cached:
-        return cached
-
-    params = {
-        "latitude": lat_n,
-        "longitude": lon_n,
-        "current": "temperature_2m,wind_speed_10m,precipitation,weather_code",
-        "timezone": "UTC",
-    }
 
     try:
-        _rate_limit_sleep()
-
-        r = _session.get(BASE_URL, params=params, timeout=TIMEOUT)
-        r.raise_for_status()
-        j = r.json()
-
-        cur = (j.get("current") or {})
-        data = {
-            "weather_source": "open-meteo",
-            "weather_temperature_c": cur.get("temperature_2m"),
-            "weather_wind_kmh": cur.get("wind_speed_10m"),
-            "weather_precip_mm": cur.get("precipitation"),
-            "weather_code": cur.get("weather_code"),
-            "weather_time_utc": cur.get("time"),
-        }
-
-        _cache_set(key, data)
-        _fail_streak = 0
-        return data
+        return _fetch_weather_cached(lat_n, lon_n, ttl_period(now))
 
     except Exception as e:
-        print(f"[Weather] fetch failed key={key}: {e}")
+        print(f"[Weather] fetch failed key={lat_n}:{lon_n}: {e}")
 
         _fail_streak += 1
         if _fail_streak >= FAIL_STREAK_MAX:
@@ -3,22 +3,16 @@ import json
 import os
 from datetime import datetime
 
+import orjson
 from dotenv import load_dotenv
-from state_store import with_locked_state
+from state_store import append_event_line
 
 load_dotenv()
 
-# Shared state file used by the Processor to correlate webhook callbacks with pending ingests.
+# Callback log shared with the Processor, which folds it into its state file to
+# correlate webhook callbacks with pending ingests.
 TMP_DIR = os.getenv("PROCESSOR_LOCAL_TMP", "tmp")
-STATE_PATH = os.path.join(TMP_DIR, "processor_state.json")
-
-# Minimal state shape (also used as a fallback if the state file does not exist yet).
-INIT_STATE = {
-    "processed_keys": [],
-    "ingest_results": {},
-    "pending_ingests": {},
-    "webhook_events": {},
-}
+WEBHOOK_LOG_PATH = os.path.join(TMP_DIR, "webhook_events.jsonl")
 
 
 def _ensure_tmp() -> None:
@@ -36,10 +30,10 @@ class Handler(BaseHTTPRequestHandler):
 
         # XML Service posts a small JSON payload with request_id/status (+ optional db_document_id/error).
         length = int(self.headers.get("Content-Length", 0))
-        raw = self.rfile.read(length).decode("utf-8") if length else ""
+        raw = self.rfile.read(length) if length else b""
 
         try:
-            payload = json.loads(raw) if raw else {}
+            payload = orjson.loads(raw) if raw else {}
         except Exception:
             # Treat invalid JSON as empty payload (keeps the server resilient).
             payload = {}
@@ -55,16 +49,12 @@ class Handler(BaseHTTPRequestHandler):
 
         _ensure_tmp()
 
-        def _tx(state):
-            # Store latest callback per request_id (Processor polls/reads this to finalize S3 moves).
-            state.setdefault("webhook_events", {})
-            state["webhook_events"][request_id] = {
-                "received_at_utc": now,
-                **payload,
-            }
-
-        # Serialize updates to the JSON file to avoid races and partial writes.
-        with_locked_state(STATE_PATH, INIT_STATE, _tx)
+        # Latest callback per request_id wins (Processor drains this to finalize S3 moves).
+        # One durable append per callback; no read/rewrite of the state file.
+        append_event_line(WEBHOOK_LOG_PATH, {
+            "request_id": request_id,
+            "event": {"received_at_utc": now, **payload},
+        })
 
         self.send_response(200)
         self.send_header("Content-Type", "application/json")